@@ -1,14 +1,20 @@
 import os
-import json
-from typing import List
+import re
+import asyncio
+import orjson
+from typing import Iterator, List
+import faiss
+import numpy as np
 import streamlit as st
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_core.documents import Document
 
 from langchain_core.prompts import PromptTemplate
 from rapidfuzz import fuzz, process
 from dotenv import load_dotenv
+import ahocorasick
 import pyttsx3
 import queue
 
@@ -20,6 +26,22 @@ FAISS_INDEX_PATH = "faiss_index"
 PERSONALITY_PATH = "data/personality_rules.json"
 GUARDIAN_INFO_PATH = "data/guardian_info.json"
 
+# Prompt skeleton, parsed once; personality comes from load_personality()
+PROMPT_TEMPLATE = PromptTemplate.from_template(
+    "\n--- FINAL PROMPT TO OPENAI ---\n{personality}"
+    "Only use the context below to answer the question. If the answer is not in the context, say 'I don't know'.\n\n"
+    "Context:\n{context}\n\nQuestion: {question}\nAnswer:"
+)
+
+# KB fields kept out of the embedded page content (audio is a raw file path)
+CONTENT_SKIP_KEYS = frozenset(("category", "audio"))
+
+# Texts per embeddings request (OpenAIEmbeddings' default chunk_size); batches are sent concurrently
+EMBED_BATCH_SIZE = 1000
+
+# HNSW graph degree for the vector index
+HNSW_M = 32
+
 # Guardrail keywords and aliases
 SAFE_KEYWORDS = [
     "baby", "birth", "child", "sleep", "dream", "ear", "eye", "brain",
@@ -44,68 +66,128 @@ SAFE_KEYWORDS = [
     "guardian", "phone", "emergency", "contact"
 ]
 
+SAFE_KEYWORDS_NORM = [kw.lower() for kw in SAFE_KEYWORDS]
+FUZZY_SCORE_CUTOFF = 80
+
+# Questions that should get the guardian contact card
+GUARDIAN_RE = re.compile(
+    r"\b(mom(?:my)?|dad(?:dy)?|guardian|emergency|(?:tele)?phone|contact|father|mother|parent)s?\b",
+    re.IGNORECASE,
+)
+
+# Single-pass keyword scanner built once from SAFE_KEYWORDS
+SAFE_AUTOMATON = ahocorasick.Automaton()
+for kw in SAFE_KEYWORDS_NORM:
+    SAFE_AUTOMATON.add_word(kw, kw)
+SAFE_AUTOMATON.make_automaton()
+
 # Helpers
-def speak(text):
-    engine = pyttsx3.init()
+@st.cache_resource
+def get_tts_engine():
+    try:
+        engine = pyttsx3.init()
+    except Exception:
+        return None  # No TTS driver available (e.g. headless server)
     engine.setProperty('rate', 180)  # Speed (optional)
+    return engine
+
+def speak(text):
+    engine = get_tts_engine()
+    if engine is None:
+        return
     engine.say(text)
     engine.runAndWait()
 def normalize_query(query):
     return query.strip().lower()
 
 def fuzzy_match_keywords(query):
-    match = process.extractOne(query, SAFE_KEYWORDS, scorer=fuzz.partial_ratio)
-    if match:
-        best, score, _ = match
-        return best if score >= 80 else None
-    return None
+    match = process.extractOne(
+        query, SAFE_KEYWORDS_NORM, scorer=fuzz.partial_ratio, processor=None, score_cutoff=FUZZY_SCORE_CUTOFF
+    )
+    return match[0] if match else None
+
+def contains_safe_keyword(text: str) -> bool:
+    return next(SAFE_AUTOMATON.iter(text), None) is not None
 
 def is_question_safe(query):
+    if contains_safe_keyword(query):
+        return True
     return fuzzy_match_keywords(query) is not None
 
-def filter_documents_by_topic(docs: List[Document]) -> List[Document]:
-    return [doc for doc in docs if any(kw in doc.page_content.lower() for kw in SAFE_KEYWORDS)]
+def are_questions_safe(queries: List[str]) -> List[bool]:
+    # Batch variant of is_question_safe: one multi-core cdist call for all fuzzy checks
+    safe = [contains_safe_keyword(q) for q in queries]
+    pending = [i for i, ok in enumerate(safe) if not ok]
+    if pending:
+        scores = process.cdist(
+            [queries[i] for i in pending], SAFE_KEYWORDS_NORM,
+            scorer=fuzz.partial_ratio, processor=None, score_cutoff=FUZZY_SCORE_CUTOFF, workers=-1,
+        )
+        for i, row in zip(pending, scores):
+            safe[i] = bool(row.max() >= FUZZY_SCORE_CUTOFF)
+    return safe
+
+def lowercase_content(doc: Document) -> str:
+    # Documents coming back from the FAISS docstore don't carry "_lc"
+    return doc.metadata.get("_lc") or doc.page_content.lower()
 
 def fallback_keyword_search(query: str, full_docs: List[Document]) -> List[Document]:
-    return [doc for doc in full_docs if query.lower() in doc.page_content.lower()]
+    query = query.lower()
+    return [doc for doc in full_docs if query in lowercase_content(doc)]
 
-def call_openai_api(query: str, docs: List[Document], prompt_prefix: str) -> str:
+def call_openai_api(query: str, docs: List[Document], prompt_prefix: str) -> Iterator[str]:
     context_texts = "\n\n".join([doc.page_content for doc in docs])
-    debug_log = f"\n--- FINAL PROMPT TO OPENAI ---\n{prompt_prefix}Only use the context below to answer the question. If the answer is not in the context, say 'I don't know'.\n\nContext:\n{context_texts}\n\nQuestion: {query}\nAnswer:"
-    st.code(debug_log, language="markdown")  # Display the exact prompt
-    llm = ChatOpenAI(temperature=0)
-    return llm.invoke(debug_log).content
-def load_json_documents(filepath: str) -> List[Document]:
-    with open(filepath, "r", encoding="utf-8") as f:
-        raw_data = json.load(f)
+    debug_log = PROMPT_TEMPLATE.format(personality=prompt_prefix, context=context_texts, question=query)
+    if st.session_state.get("debug"):
+        st.code(debug_log, language="markdown")  # Display the exact prompt
+    llm = ChatOpenAI(temperature=0, streaming=True)
+    return (chunk.content for chunk in llm.stream(debug_log))
+
+@st.cache_resource(max_entries=1)
+def load_json_documents(filepath: str, mtime: float = 0.0) -> List[Document]:
+    # mtime is unused here; it only keys the cache so an edited KB is reloaded
+    with open(filepath, "rb") as f:
+        raw_data = orjson.loads(f.read())
     docs = []
+    seen = set()
     for item in raw_data:
-        content_parts = []
-        for k, v in item.items():
-            if k not in ["category", "audio"]:  # skip raw audio from content
-                content_parts.append(f"{k.capitalize()}: {v}")
-        content = "\n".join(content_parts)
+        content = "\n".join(f"{k.capitalize()}: {v}" for k, v in item.items() if k not in CONTENT_SKIP_KEYS)
+        content_lc = content.lower()
+        # Category and audio aren't in the content, so they're part of the key
+        key = (content, item.get("audio", ""), item.get("category"))
+        if key in seen:
+            continue  # duplicate entry, would only add a redundant vector
+        seen.add(key)
         metadata = {
             "category": item.get("category", "unknown"),
             "audio": item.get("audio", ""),
             "arabic": item.get("arabic", ""),
             "usage": item.get("usage", ""),
             "translation": item.get("translation", ""),
+            "_lc": content_lc,
+            "safe": contains_safe_keyword(content_lc),
         }
         docs.append(Document(page_content=content, metadata=metadata))
+    skipped = len(raw_data) - len(docs)
+    if skipped:
+        st.write(f"🧹 Skipped {skipped} duplicate knowledge base entries.")
     return docs
 
+def get_full_doc_list() -> List[Document]:
+    return load_json_documents(DATA_PATH, os.path.getmtime(DATA_PATH))
+
 
+@st.cache_data
 def load_guardian_info():
     if not os.path.exists(GUARDIAN_INFO_PATH):
         return {}
-    with open(GUARDIAN_INFO_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(GUARDIAN_INFO_PATH, "rb") as f:
+        return orjson.loads(f.read())
 
-def get_guardian_response(query: str, guardian_info: dict) -> str:
-    for key in ["mom", "dad", "guardian", "emergency", "phone", "contact", "father", "mother", "parent"]:
-        if key in query:
-            return f"""
+@st.cache_data
+def render_guardian_info(guardian_info: dict) -> str:
+    emergency = guardian_info.get('emergency_contact', {})
+    return f"""
 **👨‍👩‍👧 Guardian Info:**
 
 - **Primary Guardian:** {guardian_info.get('guardian_name', 'N/A')} ({guardian_info.get('relationship', 'N/A')})
@@ -113,32 +195,71 @@ def get_guardian_response(query: str, guardian_info: dict) -> str:
 
 **📞 Emergency Contact:**
 
-- **Name:** {guardian_info.get('emergency_contact', {}).get('name', 'N/A')} ({guardian_info.get('emergency_contact', {}).get('relationship', 'N/A')})
-- **Phone:** {guardian_info.get('emergency_contact', {}).get('phone', 'N/A')}
+- **Name:** {emergency.get('name', 'N/A')} ({emergency.get('relationship', 'N/A')})
+- **Phone:** {emergency.get('phone', 'N/A')}
 
 **🏡 Address:** {guardian_info.get('address', 'N/A')}
 """
-    return ""
+
+def get_guardian_response(query: str, guardian_card: str) -> str:
+    return guardian_card if GUARDIAN_RE.search(query) else ""
 
 # FAISS Setup
 
+@st.cache_resource
+def get_embeddings():
+    return OpenAIEmbeddings()
+
+async def embed_all(embeddings: OpenAIEmbeddings, texts: List[str]) -> List[List[float]]:
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*(embeddings.aembed_documents(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
 def create_faiss_index():
-    documents = load_json_documents(DATA_PATH)
+    documents = get_full_doc_list()
     st.write("🔧 Creating embeddings and FAISS index...")
-    embeddings = OpenAIEmbeddings()
-    db = FAISS.from_documents(documents, embeddings)
+    embeddings = get_embeddings()
+    texts = [doc.page_content for doc in documents]
+    vectors = np.array(asyncio.run(embed_all(embeddings, texts)), dtype="float32")
+    # Vectors are stored as fp16; queries stay fp32
+    index = faiss.IndexHNSWSQ(vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, HNSW_M)
+    index.train(vectors)
+    index.add(vectors)
+    # "_lc" is an in-memory lookup aid; don't pickle a second copy of every text into the index
+    docstore = InMemoryDocstore({
+        str(i): Document(
+            page_content=doc.page_content,
+            metadata={k: v for k, v in doc.metadata.items() if k != "_lc"},
+        )
+        for i, doc in enumerate(documents)
+    })
+    db = FAISS(embeddings, index, docstore, {i: str(i) for i in range(len(documents))})
     db.save_local(FAISS_INDEX_PATH)
     return db
 
 def load_faiss_index():
     st.write("📂 Loading FAISS index from disk...")
-    embeddings = OpenAIEmbeddings()
-    return FAISS.load_local(FAISS_INDEX_PATH, embeddings, allow_dangerous_deserialization=True)
+    db = FAISS.load_local(FAISS_INDEX_PATH, get_embeddings(), allow_dangerous_deserialization=True)
+    # Indexes saved before the "safe" flag existed need it for filtered search
+    for doc_id in db.index_to_docstore_id.values():
+        doc = db.docstore.search(doc_id)
+        if isinstance(doc, Document):
+            doc.metadata.setdefault("safe", contains_safe_keyword(lowercase_content(doc)))
+    return db
+
+@st.cache_resource
+def get_faiss_index():
+    # One cached store per process: built on first run, loaded from disk after that
+    if not os.path.exists(FAISS_INDEX_PATH):
+        st.info("Creating AI knowledge base...")
+        return create_faiss_index()
+    return load_faiss_index()
 
+@st.cache_data
 def load_personality():
     st.write("🧠 Loading personality rules...")
-    with open(PERSONALITY_PATH, "r", encoding="utf-8") as f:
-        personality = json.load(f)
+    with open(PERSONALITY_PATH, "rb") as f:
+        personality = orjson.loads(f.read())
     rules = "\n".join(personality.get("response_rules", []))
     style = personality.get("teaching_style", "")
     tone = personality.get("tone", "")
@@ -152,72 +273,45 @@ def load_personality():
 st.set_page_config(page_title="My Islamic AI Friend", layout="centered")
 st.title("🕌 My Islamic AI Companion")
 st.write("Ask me anything about Islam, daily duas, or general knowledge!")
+st.sidebar.checkbox("Debug prompt", key="debug")
 
 user_question = st.text_input("What would you like to know?")
 
-if not os.path.exists(FAISS_INDEX_PATH):
-    st.info("Creating AI knowledge base...")
-    db = create_faiss_index()
-else:
-    db = load_faiss_index()
+db = get_faiss_index()
 
-full_doc_list = load_json_documents(DATA_PATH)
+full_doc_list = get_full_doc_list()
 custom_prompt_prefix = load_personality()
-guardian_info = load_guardian_info()
+guardian_card = render_guardian_info(load_guardian_info())
 
 if user_question:
     query = normalize_query(user_question)
-    if not is_question_safe(query):
+    if guardian_answer := get_guardian_response(query, guardian_card):
+        st.subheader("📞 Emergency Info")
+        st.write(guardian_answer)
+    elif not is_question_safe(query):
         st.warning("This question might be out of scope for this educational app.")
     else:
-        guardian_answer = get_guardian_response(query, guardian_info)
-        if guardian_answer:
-            st.subheader("📞 Emergency Info")
-            st.write(guardian_answer)
+        filtered_docs = db.similarity_search(query, k=2, filter={"safe": True})
+        if not filtered_docs:
+            st.info("No direct match found in vector search. Using fallback keyword match...")
+            filtered_docs = fallback_keyword_search(query, full_doc_list)
+        if not filtered_docs:
+            answer_stream = ["I don't know."]
         else:
-            retrieved_docs = db.similarity_search(query, k=2)
-            filtered_docs = filter_documents_by_topic(retrieved_docs)
-            if not filtered_docs:
-                st.info("No direct match found in vector search. Using fallback keyword match...")
-                filtered_docs = fallback_keyword_search(query, full_doc_list)
-            if not filtered_docs:
-                final_response = "I don't know."
-            else:
-                final_response = call_openai_api(query, filtered_docs, custom_prompt_prefix)
-            st.subheader("📘 Answer:")
-            # speak(final_response)
-            st.write(final_response)
-            st.subheader("📚 Retrieved Context")
-            for i, doc in enumerate(filtered_docs, 1):
-                st.markdown(f"**Result {i} | Category:** {doc.metadata.get('category', 'unknown')}")
-                st.code(doc.page_content, language="markdown")
-    if filtered_docs:
-        try:
-            audio_path = None
-            for doc in filtered_docs:
-                if "audio" in doc.metadata:
-                    audio_path = doc.metadata["audio"]
-                    arabic_text = doc.metadata["arabic"]
-                    # st.write(f"Audio file found: {audio_path}")
-                else:
-                    try:
-                        content_dict = {}
-                        for line in doc.page_content.split("\n"):
-                            if ":" in line:
-                                key, value = line.split(":", 1)
-                                content_dict[key.strip().lower()] = value.strip()
-                        audio_path = content_dict.get("audio", "")
-                        st.write(f"Extracted audio path: {audio_path}")
-                    except Exception:
-                        continue
-                if audio_path and os.path.exists(audio_path):
-                    break  # Found the first audio, stop looping
-
-            # Play the audio if found
-            if audio_path and os.path.exists(audio_path):
-                st.subheader("🔊 Listen to the Dua")
-                st.header("Dua in arabic:")
-                st.write(arabic_text)
-                st.audio(audio_path)
-        except Exception as e:
-                st.warning("Audio unavailable or format issue.")
\ No newline at end of file
+            answer_stream = call_openai_api(query, filtered_docs, custom_prompt_prefix)
+        st.subheader("📘 Answer:")
+        final_response = st.write_stream(answer_stream)
+        # speak(final_response)
+        st.subheader("📚 Retrieved Context")
+        for i, doc in enumerate(filtered_docs, 1):
+            st.markdown(f"**Result {i} | Category:** {doc.metadata.get('category', 'unknown')}")
+            st.code(doc.page_content, language="markdown")
+        audio_doc = next((doc for doc in filtered_docs if os.path.exists(doc.metadata.get("audio") or "")), None)
+        if audio_doc:
+            st.subheader("🔊 Listen to the Dua")
+            st.header("Dua in arabic:")
+            st.write(audio_doc.metadata.get("arabic", ""))
+            try:
+                st.audio(audio_doc.metadata["audio"])
+            except Exception:
+                st.warning("Audio unavailable or format issue.")